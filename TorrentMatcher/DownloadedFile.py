@@ -8,20 +8,20 @@ class DownloadedFile:
     # hash_cache[piece_size][offset] = pieces
     hash_cache: Dict[int, Dict[int, bytes]]
     
-    def __init__(self, path: str, size: int, hash_cache: Dict[int, Dict[int, bytes]]={}):
+    def __init__(self, path: str, size: int, hash_cache: Dict[int, Dict[int, bytes]]=None):
         self.size = size
         self.path = path
-        self.hash_cache = hash_cache
+        self.hash_cache = hash_cache if hash_cache is not None else {}
     
     def add_hash(self, piece_size: int, offset: int, hash: bytes):
-        if not self.hash_cache[piece_size]:
+        if piece_size not in self.hash_cache:
             self.hash_cache[piece_size] = {offset: hash}
         else:
             self.hash_cache[piece_size][offset] = hash
     
     def get_hash(self, piece_size: int, offset: int):
-        if not self.hash_cache[piece_size]:
+        if piece_size not in self.hash_cache:
             return None
-        return self.hash_cache[piece_size][offset]
+        return self.hash_cache[piece_size].get(offset)
     
     # def calculate_hashes(self, piece_length: int, offsets: List[int]) -> Dict[int, bytes]:
\ No newline at end of file
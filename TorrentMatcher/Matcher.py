@@ -3,11 +3,14 @@ import os
 import sys
 import sqlite3
 import hashlib
+from difflib import SequenceMatcher
+from functools import partial
 from traceback import print_exc, print_exception
-from typing import Dict, List, Tuple
+from typing import BinaryIO, Dict, List, Set, Tuple
 # import psutil
 
 from .DownloadedFile import DownloadedFile
+from .ResumeData import export_resume_data
 
 from .TorrentFile import BEncodeParseError, TorrentFile, WrongTorrentFileTypeError, parse_torrent
 
@@ -15,6 +18,26 @@ from .TorrentFile import BEncodeParseError, TorrentFile, WrongTorrentFileTypeErr
 # DOWNLOADED_FILE_TABLE = "downloadedFile"
 # DOWNLOADED_HASH_TABLE = "downloadedFirstHash"
 
+HASH_READ_CHUNK_SIZE: int = 1024*1024
+
+def hash_piece_prefixes(file: BinaryIO, offset: int, piece_sizes: List[int]) -> Dict[int, bytes]:
+    # one running SHA1 from offset to the largest piece size, copied at each smaller piece size boundary.
+    # A piece size past EOF gets the hash of everything up to EOF, which is what a single-file torrent
+    # smaller than one piece stores as its only piece
+    digest = hashlib.sha1(usedforsecurity=False)
+    prefix_hashes: Dict[int, bytes] = {}
+    hashed_length = 0
+    file.seek(offset)
+    for piece_size in sorted(set(piece_sizes)):
+        while hashed_length < piece_size:
+            data = file.read(min(piece_size - hashed_length, HASH_READ_CHUNK_SIZE))
+            if len(data) == 0:
+                break
+            digest.update(data)
+            hashed_length += len(data)
+        prefix_hashes[piece_size] = digest.copy().digest()
+    return prefix_hashes
+
 def setup_database(conn: sqlite3.Connection):
     cur = conn.cursor()
     """,
@@ -89,7 +112,7 @@ def setup_database(conn: sqlite3.Connection):
     conn.commit()
     
 
-def match_files(torrent_files_paths: List[str], file_search_paths: List[str], *, database_path: str=':memory:', json_path: str=None) -> List[Tuple[DownloadedFile, TorrentFile]]:
+def match_files(torrent_files_paths: List[str], file_search_paths: List[str], *, database_path: str=':memory:', json_path: str=None, compare_inline: bool=False, first_match: bool=False, resume_dir: str=None) -> List[Tuple[DownloadedFile, TorrentFile]]:
     write_json = json_path is not None and len(json_path) > 0
     if not all((os.path.exists(torrent_files_path) for torrent_files_path in torrent_files_paths)):
         raise ValueError("Torrent file path does not exist")
@@ -97,6 +120,8 @@ def match_files(torrent_files_paths: List[str], file_search_paths: List[str], *,
         raise ValueError("Path to downloaded files does not exist")
     if not all((os.path.isdir(file_search_path) for file_search_path in file_search_paths)):
         raise ValueError("Path to downloaded files must point to a folder")
+    if resume_dir is not None and not os.path.isdir(resume_dir):
+        raise ValueError("Resume data output path must point to a folder")
     conn = sqlite3.connect(database_path)
     setup_database(conn)
     
@@ -143,6 +168,7 @@ def match_files(torrent_files_paths: List[str], file_search_paths: List[str], *,
         conn.commit()
     
     torrent_files: List[TorrentFile] = []
+    torrent_files_by_path: Dict[str, TorrentFile] = {}
     
     # print(psutil.virtual_memory())
     for torrent_files_path in torrent_files_paths:
@@ -152,6 +178,7 @@ def match_files(torrent_files_paths: List[str], file_search_paths: List[str], *,
                 torrent_file = parse_torrent(torrent_file_data)
                 save_torrent_file(torrent_file, torrent_files_path)
                 torrent_files.append(torrent_file)
+                torrent_files_by_path[torrent_files_path] = torrent_file
         else:
             for root, _, files in os.walk(torrent_files_path):
                 for file in (os.path.join(root, file) for file in files):
@@ -161,6 +188,7 @@ def match_files(torrent_files_paths: List[str], file_search_paths: List[str], *,
                                 torrent_file = parse_torrent(torrent_file_data)
                                 save_torrent_file(torrent_file, file)
                                 torrent_files.append(torrent_file)
+                                torrent_files_by_path[file] = torrent_file
                         except WrongTorrentFileTypeError as wtfte:
                             print(wtfte, f"File path: {file}", sep="\n    ")
                         # except UnicodeDecodeError as ude:
@@ -185,55 +213,149 @@ def match_files(torrent_files_paths: List[str], file_search_paths: List[str], *,
                 # downloaded_files.append(DownloadedFile(file, file_size))
         conn.commit()
     
-    # TODO: fetch torrent info as well to more quickly match to full torrent path, & do it in application rather than in db
-    cur.execute("""SELECT downloadedFile.ROWID, downloadedFile.filePath, pieceSize, offset, hash 
-                FROM downloadedFile 
-                INNER JOIN torrentSingleFileHash 
-                    ON downloadedFile.fileSize = torrentSingleFileHash.fileSize 
-                ORDER BY downloadedFile.filePath""")
+    matches_json = {}
+    
+    def report_match(downloaded_path: str, torrent_file_path: str, torrent_sub_path: str):
+        if torrent_file_path not in matches_json.keys():
+            matches_json[torrent_file_path] = {}
+        if torrent_sub_path in matches_json[torrent_file_path].keys():
+            if downloaded_path not in matches_json[torrent_file_path][torrent_sub_path]:
+                matches_json[torrent_file_path][torrent_sub_path].append(downloaded_path)
+        else:
+            matches_json[torrent_file_path][torrent_sub_path] = [downloaded_path]
+        if not write_json:
+            print(f"File on disk: {downloaded_path}")
+            print(f"Torrent file: {torrent_file_path}")
+            print(f"Path within torrent: {torrent_sub_path}")
+            print()
+    
+    # expected_single_file_hashes[(file_size, piece_size, offset)][hash] = [(torrent_path, file_name)]
+    expected_single_file_hashes: Dict[Tuple[int, int, int], Dict[bytes, List[Tuple[str, str]]]] = {}
+    inline_single_file_matches: List[Tuple[str, str, str]] = []
+    if compare_inline and not first_match:
+        cur.execute("""SELECT torrentSingleFileHash.fileSize, pieceSize, offset, hash, torrentFile.torrentPath, torrentSingleFileHash.fileName
+                    FROM torrentSingleFileHash
+                    INNER JOIN torrentFile ON torrentFile.ROWID = torrentSingleFileHash.torrentFileRowId""")
+        for file_size, piece_size, offset, expected_hash, torrent_file_path, torrent_sub_path in cur:
+            hashes = expected_single_file_hashes.setdefault((file_size, piece_size, offset), {})
+            hashes.setdefault(expected_hash, []).append((torrent_file_path, torrent_sub_path))
     
     print("Fast scan finished, beginning deep scan")
-    queued_file = None
-    queued_file_rowId = None
-    # queued_df = None
-    queued_single_records: List[Tuple[int, int, bytes]] = None
-    
-    def processSingleFileQueue():
-        assert queued_file is not None
-        # start = min((record[1] for record in queued_records))
-        read_end = max((record[0]+record[1] for record in queued_single_records)) #noninclusive
-        # queued_records.sort()
-        with open(queued_file, 'rb') as testing_file:
-            testing_data = testing_file.read(read_end)
-            if len(testing_data) != read_end:
-                print(f"Unable to read full part of file {queued_file}")
-                return
-        # assert len(testing_data) == read_end
-        # last_piece_size = None
-        # last_offset = None
-        for piece_size, offset, search_hash in queued_single_records:
-            # if piece_size == last_piece_size and offset == last_offset:
-            section = testing_data[offset:offset+piece_size]
-            calculated_hash = hashlib.sha1(section, usedforsecurity=False).digest()
-            # if calculated_hash == search_hash:
-            #     print(f"Found hash match! File: {queued_file}")
-            cur.execute("INSERT OR IGNORE INTO downloadedFirstHash(fileRowId, filePath, pieceSize, offset, hash) VALUES (?, ?, ?, ?, ?)", 
-                        (queued_file_rowId, queued_file, piece_size, offset, calculated_hash))
+    if first_match:
+        cur.execute("""SELECT downloadedFile.ROWID, downloadedFile.filePath, downloadedFile.fileSize
+                    FROM downloadedFile
+                    WHERE downloadedFile.fileSize IN (SELECT fileSize FROM torrentSingleFileHash)""")
+        downloaded_files_by_size: Dict[int, List[DownloadedFile]] = {}
+        downloaded_file_row_ids: Dict[str, int] = {}
+        for ROWID, filePath, fileSize in cur.fetchall():
+            downloaded_files_by_size.setdefault(fileSize, []).append(DownloadedFile(filePath, fileSize))
+            downloaded_file_row_ids[filePath] = ROWID
+        
+        # piece_sizes_by_size_offset[(file_size, offset)] = every piece size a torrent file of that size needs there,
+        # so a candidate is hashed for all of them in one pass
+        cur.execute("SELECT DISTINCT fileSize, offset, pieceSize FROM torrentSingleFileHash")
+        piece_sizes_by_size_offset: Dict[Tuple[int, int], List[int]] = {}
+        for fileSize, offset, piece_size in cur.fetchall():
+            piece_sizes_by_size_offset.setdefault((fileSize, offset), []).append(piece_size)
+        
+        def candidate_rank(torrent_sub_path: str, target_name: str, matched_dirs: Set[str], matched_roots: Set[str],
+                           downloaded_file: DownloadedFile) -> Tuple[bool, float]:
+            colocated = (os.path.dirname(downloaded_file.path) in matched_dirs
+                         or any(os.path.join(root, torrent_sub_path) == downloaded_file.path for root in matched_roots))
+            similarity = SequenceMatcher(None, os.path.basename(downloaded_file.path).lower(), target_name).ratio()
+            return (colocated, similarity)
+        
+        cur.execute("""SELECT torrentSingleFileHash.torrentFileRowId, torrentFile.torrentPath, torrentSingleFileHash.fileName,
+                           torrentSingleFileHash.fileSize, pieceSize, offset, hash
+                    FROM torrentSingleFileHash
+                    INNER JOIN torrentFile ON torrentFile.ROWID = torrentSingleFileHash.torrentFileRowId
+                    ORDER BY torrentSingleFileHash.torrentFileRowId, torrentSingleFileHash.fileName""")
+        
+        current_torrent_row_id = None
+        # folders holding files already matched from the current torrent, and the roots they imply
+        matched_dirs: Set[str] = set()
+        matched_roots: Set[str] = set()
+        for torrent_row_id, torrent_file_path, torrent_sub_path, file_size, piece_size, offset, expected_hash in cur.fetchall():
+            if torrent_row_id != current_torrent_row_id:
+                current_torrent_row_id = torrent_row_id
+                matched_dirs = set()
+                matched_roots = set()
+            candidates = downloaded_files_by_size.get(file_size, [])
+            if len(candidates) > 1:
+                target_name = os.path.basename(torrent_sub_path).lower()
+                candidates = sorted(candidates, key=partial(candidate_rank, torrent_sub_path, target_name, matched_dirs, matched_roots), reverse=True)
+            
+            for downloaded_file in candidates:
+                calculated_hash = downloaded_file.get_hash(piece_size, offset)
+                if calculated_hash is None:
+                    with open(downloaded_file.path, 'rb') as testing_file:
+                        prefix_hashes = hash_piece_prefixes(testing_file, offset, piece_sizes_by_size_offset[(file_size, offset)])
+                    for prefix_piece_size, prefix_hash in prefix_hashes.items():
+                        downloaded_file.add_hash(prefix_piece_size, offset, prefix_hash)
+                    calculated_hash = prefix_hashes[piece_size]
+                if calculated_hash != expected_hash:
+                    continue
+                inline_single_file_matches.append((downloaded_file.path, torrent_file_path, torrent_sub_path))
+                report_match(downloaded_file.path, torrent_file_path, torrent_sub_path)
+                cur.execute("INSERT OR IGNORE INTO downloadedFirstHash(fileRowId, filePath, pieceSize, offset, hash) VALUES (?, ?, ?, ?, ?)", 
+                            (downloaded_file_row_ids[downloaded_file.path], downloaded_file.path, piece_size, offset, calculated_hash))
+                matched_dirs.add(os.path.dirname(downloaded_file.path))
+                if downloaded_file.path.endswith(os.sep + torrent_sub_path):
+                    matched_roots.add(downloaded_file.path[:-len(os.sep + torrent_sub_path)])
+                # torrent file confirmed, skip its remaining candidates
+                break
+    else:
+        # TODO: fetch torrent info as well to more quickly match to full torrent path, & do it in application rather than in db
+        cur.execute("""SELECT downloadedFile.ROWID, downloadedFile.filePath, downloadedFile.fileSize, pieceSize, offset, hash 
+                    FROM downloadedFile 
+                    INNER JOIN torrentSingleFileHash 
+                        ON downloadedFile.fileSize = torrentSingleFileHash.fileSize 
+                    ORDER BY downloadedFile.filePath""")
+    
+        queued_file = None
+        queued_file_rowId = None
+        queued_file_size = None
+        # queued_df = None
+        queued_single_records: List[Tuple[int, int, bytes]] = None
+    
+        def processSingleFileQueue():
+            assert queued_file is not None
+            # group by offset so each offset is read once, however many piece sizes share it
+            piece_sizes_by_offset: Dict[int, List[int]] = {}
+            for piece_size, offset, _ in queued_single_records:
+                try:
+                    piece_sizes_by_offset[offset].append(piece_size)
+                except KeyError:
+                    piece_sizes_by_offset[offset] = [piece_size]
+            with open(queued_file, 'rb') as testing_file:
+                for offset, piece_sizes in piece_sizes_by_offset.items():
+                    prefix_hashes = hash_piece_prefixes(testing_file, offset, piece_sizes)
+                    for piece_size, calculated_hash in prefix_hashes.items():
+                        if compare_inline:
+                            torrent_entries = expected_single_file_hashes.get((queued_file_size, piece_size, offset), {}).get(calculated_hash)
+                            if torrent_entries is None:
+                                continue
+                            for torrent_file_path, torrent_sub_path in torrent_entries:
+                                inline_single_file_matches.append((queued_file, torrent_file_path, torrent_sub_path))
+                                report_match(queued_file, torrent_file_path, torrent_sub_path)
+                        cur.execute("INSERT OR IGNORE INTO downloadedFirstHash(fileRowId, filePath, pieceSize, offset, hash) VALUES (?, ?, ?, ?, ?)", 
+                                    (queued_file_rowId, queued_file, piece_size, offset, calculated_hash))
 
         
     
-    for ROWID, filePath, piece_size, offset, found_hash in cur.fetchall():
-        if filePath != queued_file:
-            if queued_file is not None:
-                processSingleFileQueue()
-                # conn.commit()
-            queued_file = filePath
-            # queued_df: DownloadedFile = filter(lambda x: x.path == filePath, downloaded_files)[0]
-            queued_file_rowId = ROWID
-            queued_single_records = []
-        queued_single_records.append((piece_size, offset, found_hash))
-        # queued_df.add_hash(piece_size, offset, found_hash)
-    processSingleFileQueue()
+        for ROWID, filePath, fileSize, piece_size, offset, found_hash in cur.fetchall():
+            if filePath != queued_file:
+                if queued_file is not None:
+                    processSingleFileQueue()
+                    # conn.commit()
+                queued_file = filePath
+                # queued_df: DownloadedFile = filter(lambda x: x.path == filePath, downloaded_files)[0]
+                queued_file_rowId = ROWID
+                queued_file_size = fileSize
+                queued_single_records = []
+            queued_single_records.append((piece_size, offset, found_hash))
+            # queued_df.add_hash(piece_size, offset, found_hash)
+        processSingleFileQueue()
     conn.commit()
 
 
@@ -333,31 +455,23 @@ def match_files(torrent_files_paths: List[str], file_search_paths: List[str], *,
     
     print("Deep scan completed, beginning matching process")
     
-    successful_single_file_matches = cur.execute("""SELECT downloadedFile.filePath, torrentFile.torrentPath, torrentSingleFileHash.fileName
-                                     FROM downloadedFirstHash
-                                     INNER JOIN downloadedFile ON downloadedFile.ROWID = downloadedFirstHash.fileRowId
-                                     INNER JOIN torrentSingleFileHash ON downloadedFile.fileSize = torrentSingleFileHash.fileSize
-                                     AND torrentSingleFileHash.pieceSize = downloadedFirstHash.pieceSize 
-                                     AND torrentSingleFileHash.offset = downloadedFirstHash.offset
-                                     AND torrentSingleFileHash.hash = downloadedFirstHash.hash
-                                     INNER JOIN torrentFile ON torrentFile.ROWID = torrentSingleFileHash.torrentFileRowId""").fetchall()
+    if compare_inline or first_match:
+        # already compared and reported during the deep scan
+        successful_single_file_matches = inline_single_file_matches
+    else:
+        successful_single_file_matches = cur.execute("""SELECT downloadedFile.filePath, torrentFile.torrentPath, torrentSingleFileHash.fileName
+                                         FROM downloadedFirstHash
+                                         INNER JOIN downloadedFile ON downloadedFile.ROWID = downloadedFirstHash.fileRowId
+                                         INNER JOIN torrentSingleFileHash ON downloadedFile.fileSize = torrentSingleFileHash.fileSize
+                                         AND torrentSingleFileHash.pieceSize = downloadedFirstHash.pieceSize 
+                                         AND torrentSingleFileHash.offset = downloadedFirstHash.offset
+                                         AND torrentSingleFileHash.hash = downloadedFirstHash.hash
+                                         INNER JOIN torrentFile ON torrentFile.ROWID = torrentSingleFileHash.torrentFileRowId""").fetchall()
     
     print(f"Matching process complete! Found {len(successful_single_file_matches)} matches:")
-    matches_json = {}
-    for downloaded_path, torrent_file_path, torrent_sub_path in successful_single_file_matches:
-        if write_json:
-            if torrent_file_path not in matches_json.keys():
-                matches_json[torrent_file_path] = {}
-            if torrent_sub_path in matches_json[torrent_file_path].keys():
-                if downloaded_path not in matches_json[torrent_file_path][torrent_sub_path]:
-                    matches_json[torrent_file_path][torrent_sub_path].append(downloaded_path)
-            else:
-                matches_json[torrent_file_path][torrent_sub_path] = [downloaded_path]
-        else:
-            print(f"File on disk: {downloaded_path}")
-            print(f"Torrent file: {torrent_file_path}")
-            print(f"Path within torrent: {torrent_sub_path}")
-            print()
+    if not (compare_inline or first_match):
+        for downloaded_path, torrent_file_path, torrent_sub_path in successful_single_file_matches:
+            report_match(downloaded_path, torrent_file_path, torrent_sub_path)
     
     
     successful_multi_file_matches = cur.execute("""SELECT downloadedFile.filePath, torrentFile.torrentPath, torrentMultiFileHashFile.fileName
@@ -368,19 +482,18 @@ def match_files(torrent_files_paths: List[str], file_search_paths: List[str], *,
                                                 INNER JOIN torrentFile ON torrentMultiFileHash.torrentFileRowId=torrentFile.ROWID""")
     
     for downloaded_path, torrent_file_path, torrent_sub_path in successful_multi_file_matches:
-        if write_json:
-            if torrent_file_path not in matches_json.keys():
-                matches_json[torrent_file_path] = {}
-            if torrent_sub_path in matches_json[torrent_file_path].keys():
-                if downloaded_path not in matches_json[torrent_file_path][torrent_sub_path]:
-                    matches_json[torrent_file_path][torrent_sub_path].append(downloaded_path)
-            else:
-                matches_json[torrent_file_path][torrent_sub_path] = [downloaded_path]
-        else:
-            print(f"File on disk: {downloaded_path}")
-            print(f"Torrent file: {torrent_file_path}")
-            print(f"Path within torrent: {torrent_sub_path}")
-            print()
+        report_match(downloaded_path, torrent_file_path, torrent_sub_path)
+    
+    if resume_dir is not None:
+        print(f"Verifying {len(matches_json)} matched torrents and exporting resume data to {resume_dir}")
+        for torrent_file_path, matched_paths in matches_json.items():
+            torrent_file = torrent_files_by_path.get(torrent_file_path)
+            if torrent_file is None:
+                # left in a reused database by an earlier run
+                print(f"Skipping resume data for torrent not read in this run: {torrent_file_path}")
+                continue
+            complete_count, piece_count = export_resume_data(torrent_file, torrent_file_path, matched_paths, resume_dir)
+            print(f"{complete_count}/{piece_count} pieces complete: {torrent_file_path}")
     
     if write_json:
         with open(json_path, 'w') as json_file:
@@ -0,0 +1,116 @@
+import hashlib
+import json
+import os
+from typing import Dict, List, Tuple
+
+from .TorrentFile import InfoDict, TorrentFile
+
+VERIFY_READ_CHUNK_SIZE: int = 1024*1024
+
+def verify_pieces(info: InfoDict, file_paths: List[str | None]) -> bytes:
+    # file_paths[i] is the downloaded file for info.getFileLayout()[i], or None if it was not matched.
+    # Pieces touching a missing or short file are skipped instead of read and left unset in the bitfield,
+    # which has piece 0 in the high bit of the first byte like a BitTorrent bitfield message.
+    # BEP 47 pad files are never matched, they are hashed as the zeros they stand for
+    layout = info.getFileLayout()
+    assert len(layout) == len(file_paths)
+    if info.isSingleFile:
+        pad_flags = [False]
+    else:
+        pad_flags = ['p' in file.get('attr', '') for file in info.files]
+    bitfield = bytearray((len(info.pieces) + 7) // 8)
+    digest = hashlib.sha1(usedforsecurity=False)
+    piece_index = 0
+    piece_filled = 0
+    piece_ok = True
+    
+    def finish_piece():
+        nonlocal digest, piece_index, piece_filled, piece_ok
+        if piece_ok and digest.digest() == info.pieces[piece_index]:
+            bitfield[piece_index // 8] |= 0x80 >> (piece_index % 8)
+        digest = hashlib.sha1(usedforsecurity=False)
+        piece_index += 1
+        piece_filled = 0
+        piece_ok = True
+    
+    for (file_length, _), file_path, is_pad in zip(layout, file_paths, pad_flags):
+        data_file = None
+        if file_path is not None and not is_pad:
+            try:
+                data_file = open(file_path, 'rb')
+            except OSError as ose:
+                print(ose, f"File path: {file_path}", sep="\n    ")
+        try:
+            remaining = file_length
+            while remaining > 0:
+                read_length = min(remaining, info.piece_length - piece_filled, VERIFY_READ_CHUNK_SIZE)
+                if is_pad:
+                    if piece_ok:
+                        digest.update(bytes(read_length))
+                elif data_file is not None and piece_ok:
+                    data = data_file.read(read_length)
+                    if len(data) != read_length:
+                        print(f"Unable to read full file {file_path}")
+                        data_file.close()
+                        data_file = None
+                        piece_ok = False
+                    else:
+                        digest.update(data)
+                else:
+                    if data_file is not None:
+                        data_file.seek(read_length, os.SEEK_CUR)
+                    piece_ok = False
+                remaining -= read_length
+                piece_filled += read_length
+                if piece_filled == info.piece_length:
+                    finish_piece()
+        finally:
+            if data_file is not None:
+                data_file.close()
+    if piece_filled > 0:
+        finish_piece()
+    return bytes(bitfield)
+
+def export_resume_data(torrent_file: TorrentFile, torrent_path: str, matched_paths: Dict[str, List[str]], output_dir: str) -> Tuple[int, int]:
+    # matched_paths[path within torrent] = [downloaded paths], only the first of which is verified.
+    # Writes <torrent name>-<hash of torrent path>.bitfield and .resume.json to output_dir
+    info = torrent_file.info
+    layout = info.getFileLayout()
+    file_paths = [matched_paths[sub_path][0] if len(matched_paths.get(sub_path, [])) > 0 else None
+                  for _, sub_path in layout]
+    bitfield = verify_pieces(info, file_paths)
+    piece_count = len(info.pieces)
+    complete_count = sum(bin(byte).count('1') for byte in bitfield)
+    
+    # folder the torrent's own paths are relative to, if all matched files agree on one
+    content_roots = set()
+    for (_, sub_path), file_path in zip(layout, file_paths):
+        if file_path is None:
+            continue
+        if info.isSingleFile:
+            content_roots.add(os.path.dirname(file_path))
+        elif file_path.endswith(os.sep + sub_path):
+            content_roots.add(file_path[:-len(os.sep + sub_path)])
+        else:
+            content_roots.add(None)
+    content_path = content_roots.pop() if len(content_roots) == 1 else None
+    
+    resume_data = {
+        "torrent": torrent_path,
+        "name": info.name,
+        "piece_length": info.piece_length,
+        "piece_count": piece_count,
+        "pieces_complete": complete_count,
+        "bitfield": bitfield.hex(),
+        "content_path": content_path,
+        "files": [{"path": sub_path, "length": file_length, "downloaded_path": file_path}
+                  for (file_length, sub_path), file_path in zip(layout, file_paths)],
+    }
+    # torrents with the same file name in different folders must not overwrite each other's data
+    path_hash = hashlib.sha1(os.path.abspath(torrent_path).encode(), usedforsecurity=False).hexdigest()[:12]
+    output_name = f"{os.path.splitext(os.path.basename(torrent_path))[0]}-{path_hash}"
+    with open(os.path.join(output_dir, output_name + ".bitfield"), 'wb') as bitfield_file:
+        bitfield_file.write(bitfield)
+    with open(os.path.join(output_dir, output_name + ".resume.json"), 'w') as resume_file:
+        json.dump(resume_data, resume_file, indent=4)
+    return (complete_count, piece_count)
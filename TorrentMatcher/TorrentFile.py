@@ -55,6 +55,12 @@ class InfoDict:
     def __repr__(self) -> str:
         return f"InfoDict(name='{self.name}', piece_length={self.piece_length}, pieces={self.pieces}, {'length='+repr(self.length) if self.length is not None else 'files='+repr(self.files)})"
     
+    def getFileLayout(self) -> List[Tuple[int, str]]:
+        if self.length is not None:
+            #single file torrent
+            return [(self.length, self.name)]
+        return [(file['length'], os.path.join(*file['path'])) for file in self.files]
+    
     def getSingleFileHashes(self) -> Dict[str, Tuple[int, bytes]]:
         if self.length is not None:
             #single file torrent
@@ -7,6 +7,9 @@ argparser.add_argument('-t', "--torrent", dest='torrentpaths', action="append",
 argparser.add_argument('-d', "--downloads", dest='downloadfolders', action="append",  help="Root folder to search for downloaded files. Can be specified multiple times to search multiple places")
 argparser.add_argument("--database", default=':memory:', help="Database file to save to, should only be reused with the same torrent file argument. Defaults to :memory:, which does not save after the program finishes")
 argparser.add_argument('-j', "--json", dest="jsonpath", default="", help="If specified, writes all found matches to the given JSON file instead of printing to stdout")
+argparser.add_argument("--inline-compare", dest="compare_inline", action="store_true", help="Compare hashes against the torrent files in memory during the deep scan, and only save matching hashes to the database")
+argparser.add_argument("--first-match", dest="first_match", action="store_true", help="Check the downloaded files most likely to match each torrent file first, by name and by folder, and stop once it is matched. Implies --inline-compare")
+argparser.add_argument("--resume-dir", dest="resume_dir", default=None, help="If specified, verifies every matched torrent and writes a piece completion bitfield and resume data file for each one to the given folder")
 
 args = argparser.parse_args()
 
@@ -21,4 +24,4 @@ print(args)
 #     print(repr(tor))
 #     print(tor.info.getFirstFileHashes())
 
-matched_files = match_files(args.torrentpaths, args.downloadfolders, database_path=args.database, json_path=args.jsonpath)
\ No newline at end of file
+matched_files = match_files(args.torrentpaths, args.downloadfolders, database_path=args.database, json_path=args.jsonpath, compare_inline=args.compare_inline, first_match=args.first_match, resume_dir=args.resume_dir)
\ No newline at end of file